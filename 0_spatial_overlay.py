@@ -2,9 +2,11 @@ import arcpy
 import os
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 from hydro.params_nhd import nhd_regions, vpus_nhd
 from tools.efed_lib import report
+from parameters import combo_dtypes
 from paths import nhd_raster_path, weather_raster_path, cdl_path, soil_raster_path, combined_raster_path, combo_path
 
 
@@ -32,7 +34,7 @@ def overlay_rasters(outfile, *rasters):
 
 def generate_combos(combined_raster, year):
     """
-    Read the attribute table from the combined raster and reformat into a csv table
+    Read the attribute table from the combined raster and reformat into a table
     :param combined_raster: Combined raster (raster GIS file)
     :param combinations_table: Path to output table (string)
     """
@@ -47,44 +49,85 @@ def generate_combos(combined_raster, year):
     missing_fields = [k for k, v in field_map if v not in raw_fields]
     if missing_fields:
         raise KeyError(f"Fields {', '.join(missing_fields)} not found in RAT")
-    # Pull data from raster attribute table and into a new csv table
+    # Pull data from raster attribute table and into a new table, which is written to a parquet file
     else:
         new_fields, old_fields = zip(*sorted(field_map))
-        data = np.array([row for row in arcpy.da.SearchCursor(combined_raster, old_fields)])
-        table = pd.DataFrame(data, columns=new_fields)
+        # TableToNumPyArray returns a typed structured array in one call, fields ordered as in old_fields
+        data = arcpy.da.TableToNumPyArray(combined_raster, old_fields, skip_nulls=False, null_value=0)
+        table = pd.DataFrame.from_records(data)
+        table.columns = new_fields
         # Calculate area by multiplying cell count by cell area in sq. meters
-        table['area'] = table['count'] * 900
-        return table
+        table['area'] = table['count'].astype(np.uint64) * 900
+        return table.astype(combo_dtypes)
+
+
+def process_region(region, years, overwrite_raster, overwrite_combos, save_raster=True, parallel_factor="100%"):
+    """
+    Perform the raster overlay and build the combinations table for each year in a region.
+    Regions are processed in separate worker processes since arcpy environment settings apply to the whole process
+    :param region: NHD Plus hydroregion (str)
+    :param years: Years to process (iter, int)
+    :param overwrite_raster: Overwrite an existing combined raster (bool)
+    :param overwrite_combos: Overwrite an existing combinations table (bool)
+    :param save_raster: Save the combined raster to disk. If False, it is held in memory until the
+        combinations table is built (bool)
+    :param parallel_factor: Share of processor cores available to geoprocessing tools in this worker (str)
+    """
+    arcpy.env.parallelProcessingFactor = parallel_factor
+    nhd_raster = nhd_raster_path.format(vpus_nhd[region], region)
+    arcpy.env.snapRaster = nhd_raster
+    arcpy.env.mask = nhd_raster
+    for year in years:
+        print(region, year)
+        cdl_raster = cdl_path.format(year)
+        combinations_table = combo_path.format(region, year)
+        build_combos = overwrite_combos or not os.path.exists(combinations_table)
+        if save_raster:
+            combined_raster = combined_raster_path.format(region, year) + "test"
+            build_raster = overwrite_raster or not os.path.exists(combined_raster)
+        else:
+            # The combined raster is only read for its attribute table, so it doesn't need to be written to disk
+            combined_raster = f"memory\\c{region}_{year}"
+            build_raster = build_combos
+        if build_raster:
+            report("Performing raster overlay for Region {}, {}...".format(region, year))
+            try:
+                overlay_rasters(combined_raster, cdl_raster, nhd_raster)
+                report(f"Combined raster saved to {combined_raster}")
+            except Exception as e:
+                raise e
+        if build_combos:
+            report("Building combinations table for Region {}, {}...".format(region, year))
+            try:
+                combos = generate_combos(combined_raster, year)
+                combos.to_parquet(combinations_table, index=False)
+            except Exception as e:
+                raise e
+        if not save_raster and build_raster:
+            arcpy.management.Delete(combined_raster)
 
 
 def main():
     years = range(2015, 2020)  # range(2010, 2016)
     overwrite_raster = True
     overwrite_combos = False
-    regions = ['07'] + list(nhd_regions)
-    for region in regions:
-        nhd_raster = nhd_raster_path.format(vpus_nhd[region], region)
-        arcpy.env.snapRaster = nhd_raster
-        arcpy.env.mask = nhd_raster
-        for year in years:
-            print(region, year)
-            cdl_raster = cdl_path.format(year)
-            combined_raster = combined_raster_path.format(region, year) + "test"
-            combinations_table = combo_path.format(region, year)
-            if overwrite_raster or not os.path.exists(combined_raster):
-                report("Performing raster overlay for Region {}, {}...".format(region, year))
-                try:
-                    overlay_rasters(combined_raster, cdl_raster, nhd_raster)
-                    report(f"Combined raster saved to {combined_raster}")
-                except Exception as e:
-                    raise e
-            if overwrite_combos or not os.path.exists(combinations_table):
-                report("Building combinations table for Region {}, {}...".format(region, year))
-                try:
-                    combos = generate_combos(combined_raster, year)
-                    combos.to_csv(combinations_table, index=None)
-                except Exception as e:
-                    raise e
+    save_raster = True  # if False, combined rasters are held in memory and only the combinations tables are saved
+    n_workers = 4  # number of regions processed at once
+    # Region 07 is processed first. Each region must only appear once, since regions run concurrently
+    regions = ['07'] + [region for region in nhd_regions if region != '07']
+
+    # Build RATs for rasters shared by all regions up front, so that concurrent workers don't build the same RAT.
+    # Tools can use all cores here. Once the workers start, the cores are divided between them
+    arcpy.env.parallelProcessingFactor = "100%"
+    for raster in [weather_raster_path, soil_raster_path] + [cdl_path.format(year) for year in years]:
+        check_raster_RAT(arcpy.Raster(raster))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        jobs = [executor.submit(process_region, region, years, overwrite_raster, overwrite_combos, save_raster,
+                                f"{100 // n_workers}%")
+                for region in regions]
+        for job in jobs:
+            job.result()
 
 
 if __name__ == "__main__":
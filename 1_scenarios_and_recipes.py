@@ -11,6 +11,7 @@ of scenarios within watersheds.
 import os
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 # Import local modules and variables
 import modify
@@ -20,11 +21,10 @@ import write
 from paths import scratch_dir, condensed_nhd_path
 from hydro.params_nhd import nhd_regions
 from tools.efed_lib import report
-from parameters import nhd_regions, pwc_selection_field, pwc_min_selection, pwc_selection_pct
+from parameters import nhd_regions, pwc_selection_field, pwc_min_selection, pwc_selection_pct, key_dtypes
 
 from paths import pwc_scenario_path, crop_group_path, concatenated_scenario_path
 
-
 def concatenate_scenarios(regions):
     crop_groups = pd.read_csv(crop_group_path)[['pwc_class', 'pwc_class_desc']].drop_duplicates()
     for num, desc in crop_groups.values:
@@ -32,15 +32,15 @@ def concatenate_scenarios(regions):
         for region in regions:
             path = pwc_scenario_path.format(region, num, desc)
             if os.path.exists(path):
-                table = pd.read_csv(path)
-                field_order = table.columns.values
-                all_tables.append(table)
+                all_tables.append(pd.read_csv(path, engine='pyarrow'))
                 print(f"Appending table for region {region} {desc}")
             else:
                 print(f"Table for region {region} {desc} not found")
         if len(all_tables) > 0:
-            all_tables = pd.concat(all_tables, axis=0)[field_order]
-            all_tables.to_csv(concatenated_scenario_path.format(num, desc), index=None)
+            # Fields are written in the order of the first table, without reordering the concatenated table in memory
+            field_order = all_tables[0].columns
+            all_tables = pd.concat(all_tables, axis=0, ignore_index=True)
+            all_tables.to_csv(concatenated_scenario_path.format(num, desc), columns=field_order, index=None)
 
 
 def create_recipes(combos, watershed_params):
@@ -58,66 +58,111 @@ def create_recipes(combos, watershed_params):
 
     # Join combinations table with watershed params and
     # convert watershed id field from 'gridcode' to 'comid'
-    recipes = combos[['year', 'gridcode', 'scenario_index', 'area']] \
-        .merge(watershed_params, on='gridcode') \
-        .sort_values(['year', 'comid'])
+    recipes = combos[['year', 'gridcode', 'scenario_index', 'area']].merge(watershed_params, on='gridcode')
     del recipes['gridcode']
 
-    year_comid = recipes[['year', 'comid']]
-
-    # Identify rows where 'comid' or 'year' change value
-    # This will provide the row ranges for each unique comid-year pair
-    diffs = year_comid.diff()
-    diffs = diffs.sum(axis=1)
-    changes = np.nonzero(diffs.values)
-    changes = changes[0]
-    starts = np.pad(changes, (1, 0), 'constant')
-    ends = np.pad(changes, (0, 1), 'constant', constant_values=recipes.shape[0])
-    recipe_map = year_comid.iloc[starts]
+    # Group rows by unique comid-year pair. The group sizes provide the row ranges for each pair
+    groups = recipes.groupby(['year', 'comid'])
+    sizes = groups.size()
+    ends = np.cumsum(sizes.values)
+    starts = ends - sizes.values
+    recipe_map = sizes.index.to_frame(index=False)
     recipe_map['start'], recipe_map['end'] = starts, ends
 
+    # Place each row in the range for its pair. This orders the rows by year and comid without a full sort
+    position = starts[groups.ngroup().values] + groups.cumcount().values
+    order = np.empty_like(position)
+    order[position] = np.arange(position.size)
+    recipes = recipes.iloc[order]
+
     # Once recipes are generated, watershed data is no longer needed.
-    # Remove watershed parameters and aggregate common scenarios
-    for field in 'gridcode', 'year':
-        del combos[field]
-    combos = combos.groupby([f for f in combos.columns if f != 'area']).sum().reset_index()
+    # Leave out watershed parameters and aggregate common scenarios by summing area for each unique key
+    key_fields = [f for f in combos.columns if f not in ('gridcode', 'year', 'area')]
+    combos = combos.groupby(key_fields, observed=True, sort=False)['area'].sum().reset_index()
 
     return recipes[['scenario_index', 'area']], recipe_map, combos.reset_index()
 
 
+def index_params(params, on):
+    """
+    Index a small parameter table by its key field(s) for use with map_params.
+    Where a key is duplicated in the parameter table, the first row is used.
+    :param params: Parameter table containing the key field(s) (df)
+    :param on: Key field or fields (str or list)
+    :return: Parameter table indexed by key (df)
+    """
+    return params.drop_duplicates(on).set_index(on)
+
+
+def map_params(table, params, on=None):
+    """
+    Left-join a small parameter table onto a large table by key lookup. This avoids building a hash table
+    over the large table as a merge would.
+    :param table: Table to which parameters are added (df)
+    :param params: Parameter table, either indexed by key (index_params) or containing the key field(s) (df)
+    :param on: Key field or fields, if params has not already been indexed (str or list, optional)
+    :return: Table with parameter fields added (df)
+    """
+    if on is not None:
+        params = index_params(params, on)
+    on = list(params.index.names)
+    keys = table[on[0]] if len(on) == 1 else pd.MultiIndex.from_frame(table[on])
+    matched = params.reindex(keys)
+    matched.index = table.index
+    return pd.concat([table, matched], axis=1)
+
+
 def finalize_crop_dates(scenarios, crop_dates):
-    # Merge crop dates
-    dates_index = scenarios[['scenario_id', 'cdl', 'cdl_alias', 'weather_grid', 'state']]
-    state_dates = crop_dates.loc[pd.isnull(crop_dates.weather_grid)].drop('weather_grid', axis=1).drop_duplicates()
-    grid_dates = crop_dates.loc[~pd.isnull(crop_dates.weather_grid)].drop('state', axis=1).drop_duplicates()
-    crop_dates = pd.concat([dates_index.merge(grid_dates, on=['cdl', 'cdl_alias', 'weather_grid']),
-                            dates_index.merge(state_dates, on=['cdl', 'cdl_alias', 'state'])])
-    for field in ['cdl', 'weather_grid', 'state']:
-        del crop_dates[field]
-    return crop_dates
+    """
+    Match crop dates to scenarios. Crop dates are indexed either to weather grid or to state.
+    Dates indexed to weather grid are used where available, and dates indexed to state elsewhere.
+    :param scenarios: Scenarios table (df)
+    :param crop_dates: Crop dates table (df)
+    :return: Crop dates aligned with the rows of the scenarios table (df)
+    """
+    dates_index = scenarios[['cdl', 'cdl_alias', 'weather_grid', 'state']]
+    state_dates = crop_dates.loc[pd.isnull(crop_dates.weather_grid)].drop('weather_grid', axis=1)
+    grid_dates = crop_dates.loc[~pd.isnull(crop_dates.weather_grid)].drop('state', axis=1)
+    grid_dates = grid_dates.astype({'weather_grid': key_dtypes['weather_grid']})
+    date_fields = [f for f in crop_dates.columns if f not in dates_index.columns]
+
+    # Look up dates by weather grid, and fall back to state for scenarios without a match
+    # The key fields are dropped rather than the date fields selected, so the dates can be filled in below
+    dates = map_params(dates_index, grid_dates, ['cdl', 'cdl_alias', 'weather_grid']).drop(columns=dates_index.columns)
+    missing = dates.isnull().all(axis=1)
+    if missing.any():
+        state_match = map_params(dates_index[missing], state_dates, ['cdl', 'cdl_alias', 'state'])
+        dates.loc[missing, date_fields] = state_match[date_fields]
+    return dates
 
 
 def create_scenarios(combinations, soil_params, met_params, crop_params, crop_dates,
                      irrigation, curve_numbers):
     """
     Merge soil/weather/land use combinations with tabular parameter datasets.
+    Weather, crop, irrigation and curve number tables are expected to be indexed by key (index_params)
+    so that the index is built once rather than for each chunk of combinations.
     :param combinations: Combinations table (df)
-    :param soil_data: Soils data table (df)
-    :param crop_params: Cropping data table (df)
-    :param met_data: Data indexed to weather grid (df)
+    :param soil_params: Soils data table (df)
+    :param met_params: Data indexed to weather grid (df)
+    :param crop_params: Cropping data indexed to cdl and cdl_alias (df)
+    :param crop_dates: Crop dates table (df)
+    :param irrigation: Irrigation data indexed to cdl_alias and state (df)
+    :param curve_numbers: Curve numbers indexed to region and pwc_class (df)
     :return: Scenarios table (df)
     """
 
     # Merge all tables except crop dates
-    scenarios = combinations.merge(met_params, how="left", on="weather_grid")
+    # Small parameter tables are joined by lookup, the large soils table by merge
+    scenarios = map_params(combinations, met_params)
     scenarios = scenarios.merge(soil_params, how="left", on="soil_id", suffixes=("", "_soil"))
-    scenarios = scenarios.merge(crop_params, how="left", on=['cdl', 'cdl_alias'])
-    scenarios = scenarios.merge(irrigation, how="left", on=['cdl_alias', 'state'])
-    scenarios = scenarios.merge(curve_numbers, how="left", on=['region', 'pwc_class'])
+    scenarios = map_params(scenarios, crop_params)
+    scenarios = map_params(scenarios, irrigation)
+    scenarios = map_params(scenarios, curve_numbers)
 
     # Crop dates are more complicated
     crop_dates = finalize_crop_dates(scenarios, crop_dates)
-    scenarios = scenarios.merge(crop_dates, how="left", on=['scenario_id', 'cdl_alias'])
+    scenarios = scenarios.join(crop_dates, lsuffix='_x', rsuffix='_y')
 
     # 'season' occurs in both dates and cdl params. take the maximum
     scenarios['season'] = scenarios[['season_x', 'season_y']].max(axis=1)
@@ -125,11 +170,12 @@ def create_scenarios(combinations, soil_params, met_params, crop_params, crop_da
     return scenarios
 
 
-def select_pwc_scenarios(in_scenarios, crop_params):
+def select_pwc_scenarios(in_scenarios, crop_params, rng):
     """
     Sort scenarios by crop group and perform random selection for creating PWC scenarios.
     :param in_scenarios: Table containing all possible scenarios (df)
     :param crop_params: Crop data table used for identifying crop groups
+    :param rng: Random number generator used for sampling (np.random.Generator)
     :yield: Scenario selections
     """
     # Randomly sample from each crop group and save the sample
@@ -139,24 +185,25 @@ def select_pwc_scenarios(in_scenarios, crop_params):
     # First, write the entire scenario table to a 'parent' table
     yield 'all', 'parent', in_scenarios
 
+    # Sort by crop so that the scenarios for each crop or crop group can be sliced out rather than masked
+    in_scenarios = in_scenarios.sort_values(pwc_selection_field, kind='stable')
+    crop_values = in_scenarios[pwc_selection_field].values
+
     # Write a table for each crop or crop group
     for crop, crop_name in crop_groups:
-        sample = in_scenarios.loc[in_scenarios[pwc_selection_field] == crop]
+        start, end = np.searchsorted(crop_values, crop, 'left'), np.searchsorted(crop_values, crop, 'right')
+        sample = in_scenarios.iloc[start:end]
         n_scenarios = sample.shape[0]
         selection_size = max((pwc_min_selection, int(n_scenarios * (pwc_selection_pct / 100))))
         if n_scenarios > selection_size:
-            sample = sample.sample(selection_size)
+            sample = sample.take(rng.choice(n_scenarios, selection_size, replace=False))
         if not sample.empty:
             meta_table.append([crop, crop_name, n_scenarios, min((n_scenarios, selection_size))])
             yield int(crop), crop_name, sample
 
-    # Write a table describing how many scenarios were selected for each crop
-    try:
-        out_table = pd.DataFrame(np.array(meta_table),
-                                 columns=['crop', 'crop_name', 'n_scenarios', 'sample_size'])
-    except Exception as e:
-        print(e)
-        out_table = None
+    # Write a table describing how many scenarios were selected for each crop.
+    # Built from the rows directly so that each column keeps its own type
+    out_table = pd.DataFrame(meta_table, columns=['crop', 'crop_name', 'n_scenarios', 'sample_size'])
     yield 'all', 'meta', out_table
 
 
@@ -170,6 +217,8 @@ def chunk_combinations(combos):
     n_chunks = int(n_combinations / chunk_size) + 1
     if n_combinations > chunk_size:
         report(f"Breaking {n_combinations} combinations into {n_chunks} chunks", 1)
+        # Keep combinations with the same weather grid together, so each chunk draws on fewer weather grids
+        combos = combos.sort_values('weather_grid', kind='stable')
         for i, start_row in enumerate(range(0, n_combinations, chunk_size)):
             end_row = min((start_row + chunk_size, n_combinations))
             report(f"Processing chunk {i + 1}...", 2)
@@ -180,16 +229,11 @@ def chunk_combinations(combos):
         yield 1, combos
 
 
-def scenarios_and_recipes(regions, years, mode, class_filter=None):
+def read_inputs():
     """
-    Main program routine. Creates scenario and recipe (if applicable) files
-    for specified NHD Plus Hydroregions and years. Years and regions provided
-    must have corresponding input data. Specify paths to input data in paths.py
-    Mode may be either 'sam' or 'pwc'. In 'sam' mode, recipes are created and
-    aggregations are performed. In 'pwc' mode, different output files are created
-    :param regions: NHD Plus Hydroregions to process (list of strings)
-    :param years: Years to process (list of integers)
-    :param mode: 'sam' or 'pwc'
+    Read the input tables that are used for all regions and modes, so that they only need to be read once
+    when processing multiple modes.
+    :return: Weather, crop, crop dates, irrigation and soils tables (df, df, df, df, df)
     """
     report("Reading input files...")
 
@@ -204,42 +248,53 @@ def scenarios_and_recipes(regions, years, mode, class_filter=None):
     crop_dates = read.crop_dates()
     irrigation = read.irrigation()
 
-    # Read and modify data indexed to soil
+    # Read data indexed to soil
     report("Reading soils data...")
     soil_params = read.soil()
-    soil_params, aggregation_key = modify.soils(soil_params, mode)
 
-    # Create a filter if only processing certain crops
-    if class_filter is not None:
-        class_filter = pd.DataFrame({pwc_selection_field: class_filter})
+    return met_params, crop_params, crop_dates, irrigation, soil_params
 
-    # Soils, watersheds and combinations are broken up by NHD region
-    for region in regions:
-        report("Processing Region {}...".format(region))
-
-        # Read curve numbers
-        curve_numbers = read.curve_numbers(region)
-
-        # Read and modify met/crop/land cover/soil/watershed combinations
-        report("Reading combinations...")
-        combinations = read.combinations(region, years)
-        report("Processing combinations...")
-        combinations = modify.combinations(combinations, crop_params, mode, aggregation_key)
-
-        # Generate watershed 'recipes' for SAM and aggregate combinations after recipe fields removed
-        if mode == 'sam':
-            report(f"Creating watershed recipes and aggregating combinations...", 1)
-            watershed_params = pd.read_csv(condensed_nhd_path.format(region))[['gridcode', 'comid']]
-            recipes, recipe_map, combinations = create_recipes(combinations, watershed_params)
-            write.recipes(region, recipes, recipe_map)
-
-        # Create and modify scenarios, and write to file
-        report(f"Creating scenarios...", 1)
-        if mode == 'sam':
-            # Because SAM datasets do not exclude any scenarios, break into pieces to avoid memory overload
+
+def process_region(region, years, mode, params, class_filter=None, seed=None):
+    """
+    Create scenario and recipe (if applicable) files for a single NHD Plus Hydroregion.
+    Regions are independent of one another, so they can be processed in separate worker processes
+    :param region: NHD Plus Hydroregion (str)
+    :param years: Years to process (list of integers)
+    :param mode: 'sam' or 'pwc'
+    :param params: Indexed weather table, crop table, indexed crop table, crop dates, indexed irrigation table,
+        modified soils table and soil aggregation key, as prepared by scenarios_and_recipes (tuple)
+    :param class_filter: Crop classes to process (df, optional)
+    :param seed: Seed for sampling PWC scenarios. Each region is given its own so that regions processed
+        in separate processes don't draw the same random numbers (np.random.SeedSequence, optional)
+    """
+    met_index, crop_params, crop_index, crop_dates, irrigation_index, soil_params, aggregation_key = params
+    report("Processing Region {}...".format(region))
+
+    # Read curve numbers
+    curve_numbers = index_params(read.curve_numbers(region), ['region', 'pwc_class'])
+
+    # Read and modify met/crop/land cover/soil/watershed combinations
+    report("Reading combinations...")
+    combinations = read.combinations(region, years)
+    report("Processing combinations...")
+    combinations = modify.combinations(combinations, crop_params, mode, aggregation_key)
+
+    # Generate watershed 'recipes' for SAM and aggregate combinations after recipe fields removed
+    if mode == 'sam':
+        report(f"Creating watershed recipes and aggregating combinations...", 1)
+        watershed_params = pd.read_csv(condensed_nhd_path.format(region))[['gridcode', 'comid']]
+        recipes, recipe_map, combinations = create_recipes(combinations, watershed_params)
+        write.recipes(region, recipes, recipe_map)
+
+    # Create and modify scenarios, and write to file
+    report(f"Creating scenarios...", 1)
+    if mode == 'sam':
+        # Because SAM datasets do not exclude any scenarios, break into pieces to avoid memory overload
+        def scenario_chunks():
             for chunk_num, chunk in chunk_combinations(combinations):
-                scenarios = create_scenarios(chunk, soil_params, met_params, crop_params, crop_dates,
-                                             irrigation, curve_numbers)
+                scenarios = create_scenarios(chunk, soil_params, met_index, crop_index, crop_dates,
+                                             irrigation_index, curve_numbers)
 
                 # Filter out only the desired crop, if a filter is specified
                 if class_filter is not None:
@@ -249,18 +304,67 @@ def scenarios_and_recipes(regions, years, mode, class_filter=None):
 
                 scenarios = modify.scenarios(scenarios, mode, region, write_qc=False)
                 report("Writing to file...", 2)
-                write.scenarios(scenarios, mode, region, name=chunk_num)
-        elif mode == 'pwc':
-            scenarios = create_scenarios(combinations, soil_params, met_params, crop_params, crop_dates,
-                                         irrigation, curve_numbers)
-            scenarios = modify.scenarios(scenarios, mode, region)
+                yield scenarios
+
+        # Chunks are written to a single file for the region
+        write.sam_scenarios(region, scenario_chunks())
+    elif mode == 'pwc':
+        scenarios = create_scenarios(combinations, soil_params, met_index, crop_index, crop_dates,
+                                     irrigation_index, curve_numbers)
+        scenarios = modify.scenarios(scenarios, mode, region)
+
+        # For PWC, apply sampling and write crop-specific tables
+        rng = np.random.default_rng(seed)
+        for crop_num, crop_name, crop_scenarios in select_pwc_scenarios(scenarios, crop_params, rng):
+            if crop_num in (200, 210, 211):
+                report("Writing table for Region {} {}...".format(region, crop_name), 2)
+
+                write.scenarios(crop_scenarios, mode, region, name=crop_name, num=crop_num)
+
+
+def scenarios_and_recipes(regions, years, mode, class_filter=None, inputs=None, n_workers=1):
+    """
+    Main program routine. Creates scenario and recipe (if applicable) files
+    for specified NHD Plus Hydroregions and years. Years and regions provided
+    must have corresponding input data. Specify paths to input data in paths.py
+    Mode may be either 'sam' or 'pwc'. In 'sam' mode, recipes are created and
+    aggregations are performed. In 'pwc' mode, different output files are created
+    :param regions: NHD Plus Hydroregions to process (list of strings)
+    :param years: Years to process (list of integers)
+    :param mode: 'sam' or 'pwc'
+    :param class_filter: Crop classes to process (list, optional)
+    :param inputs: Input tables returned by read_inputs. Read from file if not provided (tuple, optional)
+    :param n_workers: Number of regions to process at once in separate processes (int, optional)
+    """
+    if inputs is None:
+        inputs = read_inputs()
+    met_params, crop_params, crop_dates, irrigation, soil_params = inputs
+
+    # Index the parameter tables that are joined to scenarios by lookup
+    met_index = index_params(met_params, 'weather_grid')
+    crop_index = index_params(crop_params, ['cdl', 'cdl_alias'])
+    irrigation_index = index_params(irrigation, ['cdl_alias', 'state'])
 
-            # For PWC, apply sampling and write crop-specific tables
-            for crop_num, crop_name, crop_scenarios in select_pwc_scenarios(scenarios, crop_params):
-                if crop_num in (200, 210, 211):
-                    report("Writing table for Region {} {}...".format(region, crop_name), 2)
+    # Modify data indexed to soil. The modifications depend on mode and are made in place, so work on a copy
+    report("Processing soils data...")
+    soil_params, aggregation_key = modify.soils(soil_params.copy(), mode)
 
-                    write.scenarios(crop_scenarios, mode, region, name=crop_name, num=crop_num)
+    # Create a filter if only processing certain crops
+    if class_filter is not None:
+        class_filter = pd.DataFrame({pwc_selection_field: class_filter})
+
+    # Soils, watersheds and combinations are broken up by NHD region
+    params = (met_index, crop_params, crop_index, crop_dates, irrigation_index, soil_params, aggregation_key)
+    seeds = np.random.SeedSequence().spawn(len(regions))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            jobs = [executor.submit(process_region, region, years, mode, params, class_filter, seed)
+                    for region, seed in zip(regions, seeds)]
+            for job in jobs:
+                job.result()
+    else:
+        for region, seed in zip(regions, seeds):
+            process_region(region, years, mode, params, class_filter, seed)
 
 
 def main():
@@ -270,10 +374,12 @@ def main():
     years = range(2015, 2020)
     regions = nhd_regions
     class_filter = None
+    n_workers = 4  # number of regions processed at once. Each worker holds a full region in memory
+    inputs = read_inputs()
     for mode in modes:
-        scenarios_and_recipes(regions, years, mode, class_filter)
+        scenarios_and_recipes(regions, years, mode, class_filter, inputs, n_workers)
         if mode == 'pwc':
-            concatenate_scenarios(regions, years)
+            concatenate_scenarios(regions)
 
 if __name__ == "__main__":
     main()
@@ -10,6 +10,7 @@ import os
 import re
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 # Import local modules and variables
 import plot
@@ -19,8 +20,6 @@ from tools.efed_lib import report
 from parameters import selection_percentile, area_weighting, pwc_durations, fields, max_horizons, nhd_regions, kocs
 from paths import crop_group_path
 
-# This silences some error messages being raised by Pandas
-pd.options.mode.chained_assignment = None
 
 def read_region_18(refresh=False):
     """
@@ -67,31 +66,58 @@ def get_scenarios(region_filter=None, class_filter=None):
         if pwc_input is not None:
             pwc_output = read.pwc_outfile(class_num, class_name)  # all regions
             combined = pwc_output.merge(pwc_input, on='scenario_id', how='inner')
+
+            # Split the combined table by region in one pass
+            regional_tables = dict(list(combined.groupby('region', sort=False)))
             for region in regions:
-                regional_combined = combined[combined.region == region]
-                if not regional_combined.empty:
+                regional_combined = regional_tables.get(region)
+                if regional_combined is not None:
                     yield count, region, class_num, class_name, regional_combined
                     count += 1
                 else:
                     print(f"Nothing found for region {region} {class_name}")
 
 
+def group_percentiles(area, starts):
+    """
+    Compute percentiles for rows that are sorted by group and then by concentration.
+    :param area: Area of each row (array)
+    :param starts: Row positions at which each group begins (array)
+    :return: Percentile of each row within its group (array)
+    """
+    sizes = np.diff(np.append(starts, area.size))
+    group = np.repeat(np.arange(starts.size), sizes)
+    if area_weighting:
+        # Cumulative area within the group, up to the midpoint of each row
+        cumulative = np.cumsum(area)
+        group_cumulative = cumulative - (cumulative[starts] - area[starts])[group]
+        return ((group_cumulative - 0.5 * area) / np.add.reduceat(area, starts)[group]) * 100
+    else:
+        return ((np.arange(area.size) - starts[group] + 1) / sizes[group]) * 100
+
+
 def compute_percentiles(scenarios):
     """
     Rank all scenarios by EEC and assign a percentile value, weighted by the area of the scenario (if selected).
     :param scenarios: Table of scenarios and EECs (df)
     :return: Scenarios table with new percentiles field (df)
     """
-    local_sets = []
-    for koc in kocs:
-        for duration in pwc_durations:
-            local_set = scenarios[(scenarios.koc == koc) & (scenarios.duration == duration)].sort_values('conc')
-            if area_weighting:
-                local_set['%ile'] = ((np.cumsum(local_set.area) - 0.5 * local_set.area) / local_set.area.sum()) * 100
-            else:
-                local_set['%ile'] = ((local_set.index + 1) / local_set.shape[0]) * 100
-            local_sets.append(local_set)
-    scenarios = pd.concat(local_sets, axis=0).reset_index()
+    # Sort by koc, duration (in the order of pwc_durations) and concentration in a single pass.
+    # Filtering and sorting are combined into one set of row positions so the output is copied only once.
+    # Durations are ranked by their position in pwc_durations. Durations not in pwc_durations are given -1
+    duration_rank = pd.Index(pwc_durations).get_indexer(scenarios.duration)
+    keep = np.flatnonzero(scenarios.koc.isin(kocs).values & (duration_rank >= 0))
+    duration_rank = duration_rank[keep]
+    koc = scenarios.koc.values[keep]
+    order = np.lexsort((scenarios.conc.values[keep], duration_rank, koc))
+    scenarios = scenarios.take(keep[order])
+    duration_rank, koc = duration_rank[order], koc[order]
+
+    # Compute percentiles within each koc/duration group, using the positions where each group begins
+    group_start = np.ones(koc.size, dtype=bool)
+    group_start[1:] = (koc[1:] != koc[:-1]) | (duration_rank[1:] != duration_rank[:-1])
+    scenarios['%ile'] = group_percentiles(scenarios.area.values, np.flatnonzero(group_start))
+    scenarios = scenarios.reset_index()
 
     return scenarios
 
@@ -104,20 +130,20 @@ def select_scenarios(scenarios):
     :return: Combined table of all selected scenarios (df)
     """
 
-    # Select scenarios for each of the durations and combine
-    all_selected = []
-    for duration in pwc_durations:
-        for koc in kocs:
-            selection_set = scenarios[(scenarios.duration == duration) & (scenarios.koc == koc)]
-            selection_set['dev'] = (selection_set['%ile'] - selection_percentile).abs()
-            rank = selection_set.sort_values(['dev', 'area'], ascending=[True, False]).index
-            selected_conc = selection_set.loc[rank].iloc[0].conc
-            selection = selection_set[selection_set.conc == selected_conc] \
-                .sort_values('area', ascending=False) \
-                .iloc[0].to_frame().T
-            all_selected.append(selection)
-    all_selected = \
-        pd.concat(all_selected, axis=0).sort_values(['koc', 'duration'], ascending=True).reset_index()
+    # Select scenarios for each of the durations and kocs at once
+    group_fields = ['koc', 'duration']
+    scenarios = scenarios.assign(dev=(scenarios['%ile'] - selection_percentile).abs())
+
+    # Find the concentration nearest to the selection percentile in each group. Ties go to the largest area.
+    # Only the rows at the minimum deviation for their group are sorted, rather than the whole table
+    min_dev = scenarios.groupby(group_fields, observed=True)['dev'].transform('min')
+    nearest = scenarios[scenarios.dev == min_dev]
+    nearest = nearest.sort_values('area', ascending=False).drop_duplicates(group_fields)
+
+    # Of the scenarios with the selected concentration, select the one with the largest area
+    all_selected = scenarios.merge(nearest[group_fields + ['conc']], on=group_fields + ['conc'])
+    all_selected = all_selected.sort_values('area', ascending=False).drop_duplicates(group_fields)
+    all_selected = all_selected.sort_values(group_fields, ascending=True).reset_index()
 
     # Partition selection into raw scenarios and a 'results' table containing the concentrations
     out_fields = list(fields.fetch('pwc_scenario')) + list(fields.fetch('selection'))
@@ -152,15 +178,30 @@ def report_region(scenarios, region, class_name, class_num):
     return selection
 
 
-def main():
+def initialize_fields():
+    """
+    Expand the horizon fields used in the output tables. Worker processes run this on startup so that
+    they use the same fields as the main process
+    """
+    fields.refresh()
     fields.expand('horizon', max_horizons)
+
+
+def main():
+    initialize_fields()
     region_filter = None
     class_filter = [200, 210, 211]
-
-    for i, region, class_num, class_name, scenarios in get_scenarios(region_filter, class_filter):
-        report(f"Working on Region {region} {class_name}...")
-        selection = report_region(scenarios, region, class_name, class_num)
-        write.selected_scenarios(selection, i == 0)
+    n_workers = 4  # number of region/class tables processed at once
+
+    # Each region and class is analyzed independently in a worker process. Selections are written
+    # from the main process in the order they were read, since all selections go to the same file
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=initialize_fields) as executor:
+        jobs = []
+        for _, region, class_num, class_name, scenarios in get_scenarios(region_filter, class_filter):
+            report(f"Working on Region {region} {class_name}...")
+            jobs.append(executor.submit(report_region, scenarios, region, class_name, class_num))
+        for i, job in enumerate(jobs):
+            write.selected_scenarios(job.result(), i == 0)
 
 
 if __name__ == "__main__":
@@ -125,9 +125,9 @@ def main():
     # Write output
     all_dates = pd.concat([fixed_dates, variable_dates], axis=0) \
         .dropna(subset=['cdl']) \
-        .sort_values(['cdl', 'state', 'weather_grid'])[fields.fetch('crop_dates')]
+        .sort_values(['cdl', 'state', 'weather_grid'])
     all_dates.loc[pd.isnull(all_dates.season), 'season'] = 1
-    all_dates.to_csv(dates_output, index=None)
+    all_dates[fields.fetch('crop_dates')].to_csv(dates_output, index=None)
 
 
 main()
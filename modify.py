@@ -14,29 +14,39 @@ import datetime as dt
 import write
 from tools.efed_lib import report
 from parameters import fields, max_horizons, hydro_soil_group, uslep_values, aggregation_bins, depth_bins, \
-    usle_m_vals, usle_m_bins, date_fmt, pwc_selection_field, chunk_size
-
-# This silences some error messages being raised by Pandas
-pd.options.mode.chained_assignment = None
+    usle_m_vals, usle_m_bins, date_fmt, pwc_selection_field, chunk_size, key_dtypes
 
 
 def date_to_num(params):
     # Convert dates to days since Jan 1
+    epoch = pd.Timestamp("1900-01-01")
     for field in fields.fetch('date', field_filter=params.columns):
-        params[field] = (pd.to_datetime(params[field], format=date_fmt) - pd.to_datetime("1900-01-01")).dt.days
+        params[field] = (pd.to_datetime(params[field], format=date_fmt) - epoch).dt.days
     return params
 
 
 def num_to_date(params):
+    # Convert days since Jan 1 to dates. Missing or out of range values are written as 'n/a'
+    epoch = dt.date(2001, 1, 1)
+
     def n_to_d(date):
         try:
-            return (dt.date(2001, 1, 1) + dt.timedelta(days=int(date))).strftime(date_fmt)
+            return (epoch + dt.timedelta(days=int(date))).strftime(date_fmt)
         except (ValueError, OverflowError):
             return 'n/a'
 
+    # Days within the range of pandas timestamps are converted together, and the rest one at a time
+    min_days, max_days = (pd.Timestamp.min.date() - epoch).days + 1, (pd.Timestamp.max.date() - epoch).days
     for field in fields.fetch('date'):
         if field in params.columns:
-            params[field] = params[field].apply(n_to_d)
+            days = pd.to_numeric(params[field], errors='coerce')
+            in_range = days.between(min_days, max_days)
+            dates = pd.Timestamp(epoch) + pd.to_timedelta(np.trunc(days.where(in_range)), unit='D')
+            dates = dates.dt.strftime(date_fmt).astype(object)
+            outside = days.notnull() & ~in_range
+            if outside.any():
+                dates[outside] = days[outside].apply(n_to_d)
+            params[field] = dates.fillna('n/a')
     return params
 
 
@@ -52,31 +62,41 @@ def aggregate_soils(in_soils):
     """
     from parameters import aggregation_bins
 
-    # Sort data into bins
-    out_data = [in_soils.hsg_letter]
+    # Sort data into bins. Soils are grouped on their bin numbers, folded into a single integer key,
+    # and text labels (e.g., l1, l2 for slope) are only built for the aggregated soils.
+    # Values outside of the bins are given a code after the last bin and labeled 'nan'
+    hsg_codes, hsg_letters = pd.factorize(in_soils.hsg_letter)
+    key = hsg_codes.astype(np.int64)
+    bin_codes = []
     for field, field_bins in aggregation_bins.items():
-        # Designate aggregated field labels (e.g., l1, l2 for slope) and apply with 'cut'
-        labels = [field[2 if field == "slope" else 1] + str(i) for i in range(1, len(field_bins))]
-        sliced = pd.cut(in_soils[field].fillna(0), field_bins, labels=labels, right=False, include_lowest=True)
-        out_data.append(sliced.astype("str"))
-    soil_agg = pd.concat(out_data, axis=1)
-
-    # Create aggregation key in soil_id field
-    invalid = pd.isnull(soil_agg[['hsg_letter', 'slope', 'orgC_5', 'sand_5', 'clay_5']]).any(axis=1)
-    in_soils.loc[:, 'soil_id'] = 'invalid_soil_tp'
-    in_soils.loc[~invalid, 'soil_id'] = \
-        soil_agg['hsg_letter'] + \
-        soil_agg['slope'] + \
-        soil_agg['orgC_5'] + \
-        soil_agg['sand_5'] + \
-        soil_agg['clay_5']
+        n_bins = len(field_bins) - 1
+        codes = pd.cut(in_soils[field].fillna(0), field_bins, labels=False, right=False, include_lowest=True)
+        codes = np.nan_to_num(np.asarray(codes, dtype=np.float64), nan=n_bins).astype(np.int64)
+        key = key * (n_bins + 1) + codes
+        bin_codes.append(codes)
+
+    # Soils without a hydrologic soil group are not aggregated
+    key[hsg_codes < 0] = -1
+
+    # Create aggregation key in soil_id field, naming each aggregated soil from the bins of its first soil
+    unique_keys, first = np.unique(key, return_index=True)
+    soil_ids = hsg_letters.values.astype(object)[hsg_codes[first]]
+    for (field, field_bins), codes in zip(aggregation_bins.items(), bin_codes):
+        labels = [field[2 if field == "slope" else 1] + str(i) for i in range(1, len(field_bins))] + ['nan']
+        soil_ids = soil_ids + np.array(labels, dtype=object)[codes[first]]
+    soil_ids = pd.Series(soil_ids, index=unique_keys)
+    soil_ids[soil_ids.index < 0] = 'invalid_soil_tp'
+    in_soils['soil_id'] = soil_ids.reindex(key).values
 
     # Group by aggregation key and take the mean of all properties except HSG, which will use mode
     fields.refresh()
     fields.expand('depth_weight', depth_bins)
-    averaged = in_soils.groupby('soil_id')[fields.fetch('agg_mean')].mean().reset_index()
-    hydro_group = in_soils.groupby('soil_id')[['hydro_group']].max()
-    aggregated = averaged.merge(hydro_group, on='soil_id')
+    groups = in_soils.groupby(key)
+    aggregated = groups[fields.fetch('agg_mean')].mean()
+    aggregated['hydro_group'] = groups['hydro_group'].max()
+    aggregated.insert(0, 'soil_id', soil_ids.reindex(aggregated.index).values)
+    aggregated = aggregated.reset_index(drop=True)
+
     aggregation_key = in_soils[['mukey', 'soil_id']].drop_duplicates().sort_values(by=['mukey'])
     return aggregated, aggregation_key
 
@@ -94,11 +114,14 @@ def combinations(combos, crop_params, mode, agg_key):
 
     # Split double-cropped classes into individual scenarios
     double_crops = \
-        crop_params[['cdl', 'cdl_alias']].drop_duplicates().sort_values('cdl').astype(np.uint16)
+        crop_params[['cdl', 'cdl_alias']].drop_duplicates().sort_values('cdl')
     combos = combos.merge(double_crops, on='cdl', how='left')
 
     # SAM - agg_key is ['mukey', 'state', 'soil_id']
     # PWC - agg_key is ['mukey', 'state']
+    # Aggregated soil ids are strings. As a category they're carried through the merge and grouped as integer codes
+    if 'soil_id' in agg_key.columns:
+        agg_key = agg_key.astype({'soil_id': 'category'})
     combos = combos.merge(agg_key, on='mukey', how='left')
 
     # Aggregate combinations by soil (SAM)
@@ -115,19 +138,14 @@ def combinations(combos, crop_params, mode, agg_key):
     aggregate_fields = [c for c in combos.columns if c != "area"]
     n_combos = combos.shape[0]
 
-    # Write the combinations table to disk. It's easier to process this way.
-    combos.to_csv("combos.csv", index=None)
-    del combos
-
-
+    # Aggregate in blocks to limit the size of the groupby intermediates, then combine the block totals.
+    # Blocks are sliced from the table in memory rather than spilled to and re-read from disk
+    # Output order doesn't matter, so groups are neither sorted nor expanded to unobserved categories
     blocks = []
     for i in range(0, n_combos, chunk_size):
-        block = pd.read_csv("combos.csv", skiprows=range(1, i), nrows=chunk_size)
-        block = block.groupby(aggregate_fields).sum().reset_index()
-        blocks.append(block)
+        blocks.append(combos.iloc[i:i + chunk_size].groupby(aggregate_fields, observed=True, sort=False).sum())
     combos = pd.concat(blocks, axis=0)
-    combos = combos.groupby(aggregate_fields).sum().reset_index()  # big overhead jump
-    combos['region'] = combos.region.astype("str").str.zfill(2)
+    combos = combos.groupby(level=aggregate_fields, observed=True, sort=False).sum().reset_index()
 
     # Create a unique identifier
     combos['scenario_id'] = combos.soil_id.astype("str") + \
@@ -147,35 +165,30 @@ def depth_weight_soils(in_soils):
     fields.refresh()
     depth_fields = fields.fetch('depth_weight')
 
-    # Generate weighted columns for each bin
-    depth_weighted = []
-    for bin_top, bin_bottom in zip([0] + list(depth_bins[:-1]), list(depth_bins)):
-        bin_table = np.zeros((in_soils.shape[0], len(depth_fields)))
-
-        # Perform depth weighting on each horizon
-        for i in range(max_horizons):
-            # Adjust values by bin
-            horizon_bottom = in_soils['horizon_bottom_{}'.format(i + 1)]
-            horizon_top = in_soils['horizon_top_{}'.format(i + 1)]
-
-            # Get the overlap between the SSURGO horizon and soil bin
-            overlap = (horizon_bottom.clip(upper=bin_bottom) - horizon_top.clip(lower=bin_top)).clip(0)
-            ratio = (overlap / (horizon_bottom - horizon_top)).fillna(0)
-
-            # Add the values
-            value_fields = ["{}_{}".format(f, i + 1) for f in depth_fields]
-            bin_table += in_soils[value_fields].fillna(0).mul(ratio, axis=0).values
-
-        # Add columns
-        bin_table = \
-            pd.DataFrame(bin_table, columns=["{}_{}".format(f, bin_bottom) for f in depth_fields])
-        depth_weighted.append(bin_table)
+    # Arrange horizon data as arrays of (soil, horizon) and (soil, horizon, field)
+    n_soils, horizons = in_soils.shape[0], range(1, max_horizons + 1)
+    horizon_top = in_soils[[f'horizon_top_{i}' for i in horizons]].to_numpy(np.float64)[:, :, None]
+    horizon_bottom = in_soils[[f'horizon_bottom_{i}' for i in horizons]].to_numpy(np.float64)[:, :, None]
+    values = in_soils[[f'{f}_{i}' for i in horizons for f in depth_fields]].fillna(0).to_numpy(np.float64)
+    values = values.reshape(n_soils, max_horizons, len(depth_fields))
+
+    # Get the overlap between each SSURGO horizon and each soil bin, as a ratio of horizon thickness
+    bin_top, bin_bottom = np.append(0, depth_bins[:-1]), np.array(depth_bins)
+    overlap = (np.minimum(horizon_bottom, bin_bottom) - np.maximum(horizon_top, bin_top)).clip(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = overlap / (horizon_bottom - horizon_top)
+    ratio[np.isnan(ratio)] = 0
+
+    # Sum the weighted values of all horizons for each bin and field
+    depth_weighted = np.einsum('shb,shf->sbf', ratio, values).reshape(n_soils, -1)
+    depth_weighted = \
+        pd.DataFrame(depth_weighted, columns=[f'{f}_{b}' for b in depth_bins for f in depth_fields])
 
     # Clear all fields corresponding to horizons, and add depth-binned data
     fields.expand('horizon', max_horizons)  # this will add all the _n fields
     for field in fields.fetch('horizon'):
         del in_soils[field]
-    in_soils = pd.concat([in_soils.reset_index()] + depth_weighted, axis=1)
+    in_soils = pd.concat([in_soils.reset_index(), depth_weighted], axis=1)
 
     return in_soils
 
@@ -189,7 +202,8 @@ def met(met_params):
     # 'stationID' is the id field corresponding to the original (2015) weather files
     # Eventually will likely move to a new scheme
     met_params['weather_grid'] = met_params.pop('stationID')
-    met_params = met_params.astype({'weather_grid': np.int32})
+    # State is used as a join key for irrigation and crop dates, and is carried into every scenario
+    met_params = met_params.astype({'weather_grid': key_dtypes['weather_grid'], 'state': 'category'})
     return met_params
 
 
@@ -271,25 +285,28 @@ def scenarios(in_scenarios, mode, region, write_qc=True):
     from parameters import anetd
 
     # Assigns 'cover' and 'fallow' curve numbers for each scenario based on hydrologic soil group
-    in_scenarios['cn_cov'] = in_scenarios['cn_fal'] = -1.
-
-    # Do cultivated crops, then non-cultivated crops
-    for cultivated, col in enumerate(('non-cultivated', 'cultivated')):
-        # Convert from HSG number (hydro_group) to letter
-        # For drained soils, fallow is set to D condition
-        for hsg_num, hsg_letter in enumerate(hydro_soil_group[col]):
-            sel = (in_scenarios.hydro_group == hsg_num + 1) & (in_scenarios.cultivated == cultivated)
-            in_scenarios.loc[sel, 'cn_cov'] = in_scenarios.loc[sel, f'cn_cov_{hsg_letter}']
-            in_scenarios.loc[sel, 'cn_fal'] = in_scenarios.loc[sel, f'cn_fal_{hsg_letter}']
+    # Convert from HSG number (hydro_group) to letter, non-cultivated crops in row 0 and cultivated crops in row 1
+    # For drained soils, fallow is set to D condition
+    hsg_letters = ['A', 'B', 'C', 'D']
+    letter_index = np.array([[hsg_letters.index(letter) for letter in hydro_soil_group[col]]
+                             for col in ('non-cultivated', 'cultivated')], dtype=np.int8)
+    hydro_group = in_scenarios.hydro_group.to_numpy()
+    cultivated = in_scenarios.cultivated.to_numpy()
+    valid = np.flatnonzero(np.isin(hydro_group, np.arange(1, letter_index.shape[1] + 1)) & np.isin(cultivated, (0, 1)))
+    letter = letter_index[cultivated[valid].astype(np.intp), hydro_group[valid].astype(np.intp) - 1]
+    for param in ('cn_cov', 'cn_fal'):
+        curve_numbers = in_scenarios[[f'{param}_{hsg}' for hsg in hsg_letters]].to_numpy(dtype=np.float64)
+        values = np.full(in_scenarios.shape[0], -1.)
+        values[valid] = curve_numbers[valid, letter]
+        in_scenarios[param] = values
 
     # Calculate max irrigation rate by the USDA curve number method
-    in_scenarios['max_irrigation'] = 0.2 * (((2540. / in_scenarios.cn_cov) - 25.4))  # cm
+    in_scenarios['max_irrigation'] = 0.2 * ((2540. / in_scenarios.cn_cov.to_numpy()) - 25.4)  # cm
 
     # Ensure that root and evaporation depths are 0.5 cm or more shallower than soil depth
-    in_scenarios['root_depth'] = \
-        np.minimum(in_scenarios.root_zone_max.values - 0.5, in_scenarios.max_root_depth)
-    in_scenarios['evaporation_depth'] = \
-        np.minimum(in_scenarios.root_zone_max.values - 0.5, anetd)
+    max_depth = in_scenarios.root_zone_max.to_numpy() - 0.5
+    in_scenarios['root_depth'] = np.minimum(max_depth, in_scenarios.max_root_depth.to_numpy())
+    in_scenarios['evaporation_depth'] = np.minimum(max_depth, anetd)
 
     # Choose output fields and perform data correction
     report("Performing data correction...", 3)
@@ -348,42 +365,59 @@ def soils(in_soils, mode):
     in_soils = in_soils[~((in_soils.horizon_letter == 'O') & (in_soils.horizon_bottom <= o_horizon_max))]
 
     # Sort table by horizon depth and get horizon information
+    # Horizons are numbered by their position in the run of rows for each component
     in_soils = in_soils.sort_values(['cokey', 'horizon_top'])
     in_soils['thickness'] = in_soils['horizon_bottom'] - in_soils['horizon_top']
-    in_soils['horizon_num'] = np.int16(in_soils.groupby('cokey').cumcount()) + 1
-    in_soils = in_soils.sort_values('horizon_num', ascending=False)
-    in_soils = in_soils[~(in_soils.horizon_num > max_horizons)]
-
-    # Extend columns of data for multiple horizons
-    horizon_data = in_soils.set_index(['cokey', 'horizon_num'])[fields.fetch('horizon')]
-    horizon_data = horizon_data.unstack().sort_index(1, level=1)
-    horizon_data.columns = ['_'.join(map(str, i)) for i in horizon_data.columns]
-
-    # Initialize empty fields for fields linked to soil horizons
+    cokey = in_soils.cokey.values
+    new_component = np.ones(cokey.size, dtype=bool)
+    new_component[1:] = cokey[1:] != cokey[:-1]
+    component_start = np.flatnonzero(new_component)
+    run_start = np.repeat(component_start, np.diff(np.append(component_start, cokey.size)))
+    horizon_num = np.arange(cokey.size) - run_start + 1
+    keep = horizon_num <= max_horizons
+    in_soils['horizon_num'] = np.int16(horizon_num)
+    in_soils = in_soils[keep]
+
+    # Extend columns of data for multiple horizons. Each value is placed by its component and horizon number,
+    # and horizons that a component doesn't have are left empty
+    position = ((np.cumsum(new_component) - 1) * max_horizons + horizon_num - 1)[keep]
+    horizon_data = {}
     for f in fields.fetch('horizon'):
-        for i in range(in_soils.horizon_num.max(), max_horizons + 1):
-            horizon_data["{}_{}".format(f, i)] = np.nan
+        values = in_soils[f].to_numpy()
+        wide = np.full(component_start.size * max_horizons, np.nan,
+                       dtype=values.dtype if values.dtype.kind == 'f' else object)
+        wide[position] = values
+        wide = wide.reshape(-1, max_horizons)
+        for i in range(max_horizons):
+            horizon_data["{}_{}".format(f, i + 1)] = wide[:, i]
         del in_soils[f]
+    horizon_data = pd.DataFrame(horizon_data, index=cokey[component_start])
 
-    # Add horizontal data to table
-    in_soils = in_soils.drop_duplicates(['mukey', 'cokey']).merge(horizon_data, left_on='cokey', right_index=True)
+    # Add horizontal data to table. The last (deepest) row for each component carries the number of horizons
+    in_soils = in_soils.drop_duplicates(['mukey', 'cokey'], keep='last').merge(
+        horizon_data, left_on='cokey', right_index=True)
     in_soils = in_soils.rename(columns={'horizon_num': 'n_horizons'})
 
     # New HSG code - take 'max' of two versions of hsg
     hsg_to_num = {hsg: i + 1 for i, hsg in enumerate(hydro_soil_group.name)}
     num_to_hsg = {v: k.replace("/", "") for k, v in hsg_to_num.items()}
-    in_soils['hydro_group'] = in_soils[['hydro_group', 'hydro_group_dominant']].applymap(
-        lambda x: hsg_to_num.get(x)).max(axis=1).fillna(-1).astype(np.int32)
+    hydro_group = in_soils.hydro_group.map(hsg_to_num).to_numpy(np.float64)
+    hydro_group_dominant = in_soils.hydro_group_dominant.map(hsg_to_num).to_numpy(np.float64)
+    in_soils['hydro_group'] = np.nan_to_num(np.fmax(hydro_group, hydro_group_dominant), nan=-1).astype(np.int32)
     in_soils['hsg_letter'] = in_soils['hydro_group'].map(num_to_hsg)
 
     # Calculate USLE variables
     # Take the value from the top horizon with valid kwfact values
-    in_soils['usle_k'] = in_soils[["usle_k_horiz_{}".format(i + 1) for i in range(max_horizons)]].bfill(1).iloc[:, 0]
-    m = usle_m_vals[np.int16(pd.cut(in_soils.slope.values, usle_m_bins, labels=False))]
-    sine_theta = np.sin(np.arctan(in_soils.slope / 100))  # % -> sin(rad)
+    usle_k = in_soils[["usle_k_horiz_{}".format(i + 1) for i in range(max_horizons)]].to_numpy(np.float64)
+    in_soils['usle_k'] = usle_k[np.arange(usle_k.shape[0]), np.argmax(~np.isnan(usle_k), axis=1)]
+
+    # Look up slope bins. Bins include their upper bound, and slopes beyond the last bin are put in the last bin
+    slope = in_soils.slope.to_numpy(np.float64)
+    m = usle_m_vals[np.searchsorted(usle_m_bins, slope).clip(1, len(usle_m_vals)) - 1]
+    sine_theta = np.sin(np.arctan(slope / 100))  # % -> sin(rad)
     in_soils['usle_ls'] = (in_soils.slope_length / 72.6) ** m * (65.41 * sine_theta ** 2. + 4.56 * sine_theta + 0.065)
-    in_soils['usle_p'] = np.array(uslep_values)[
-        np.int16(pd.cut(in_soils.slope, aggregation_bins['slope'], labels=False))]
+    in_soils['usle_p'] = \
+        np.array(uslep_values)[np.searchsorted(aggregation_bins['slope'], slope).clip(1, len(uslep_values)) - 1]
 
     # Set n_horizons to the first invalid horizon
     horizon_fields = [f for f in fields.fetch('horizon') if f in fields.fetch('pwc_scenario')]
@@ -31,6 +31,14 @@ chunk_size = 2000000
 # Raster cell size
 cell_size = 30
 
+# Data types for the combinations table. Raster attribute values are all unsigned integers
+combo_dtypes = {'combo_id': np.uint32, 'count': np.uint32, 'mukey': np.uint32, 'cdl': np.uint16,
+                'weather_grid': np.uint32, 'gridcode': np.uint32, 'area': np.uint64}
+
+# Data types for the keys that join parameter tables to combinations. Keys are given the same type
+# in every table so that lookups compare them directly instead of converting to a common type
+key_dtypes = {'cdl': np.uint16, 'cdl_alias': np.uint16, 'weather_grid': np.uint32}
+
 # Hydrologic soil groups
 hydro_soil_group = pd.DataFrame(
     {'name': ['A', 'A/D', 'B', 'B/D', 'C', 'C/D', 'D'],
@@ -40,7 +40,7 @@ weather_raster_path = os.path.join(input_dir, "WeatherFileGrid", "stations")
 
 # Intermediate datasets
 weather_path = os.path.join(input_dir, "WeatherFiles", "met{}")  # region
-combo_path = os.path.join(intermediate_dir, "Combinations", "{}_{}.csv")  # region, state, year
+combo_path = os.path.join(intermediate_dir, "Combinations", "{}_{}.parquet")  # region, state, year
 met_grid_path = os.path.join(intermediate_dir, "Weather", "met_stations.csv")
 processed_soil_path = os.path.join(intermediate_dir, "ProcessedSoils", "{}", "region_{}")  # mode, region
 combined_raster_path = os.path.join(intermediate_dir, "CombinedRasters", "c{}_{}")
@@ -63,7 +63,8 @@ remote_shapefile_path = os.altsep.join(("National", "Shapefiles"))
 # Production data
 hydro_file_path = os.path.join(production_dir, "HydroFiles", "region_{}_{}.{}")  # region, type, ext
 recipe_path = os.path.join(production_dir, "RecipeFiles", "r{}")  # region
-sam_scenario_path = os.path.join(production_dir, "SamScenarios", "r{}_{}.csv")  # region, chunk
+sam_scenario_path = os.path.join(production_dir, "SamScenarios", "r{}_{}.csv")  # region, name
+sam_parquet_path = os.path.join(production_dir, "SamScenarios", "r{}.parquet")  # region
 pwc_scenario_path = os.path.join(production_dir, "PwcScenarios", "{1}_{2}",
                                  "{0}_{1}_{2}.csv")  # region, crop num, crop name
 pwc_outfile_path = os.path.join(production_dir, "PwcOutput", "{}_{}_all_{}_koc{}")  # crop_num, i, koc
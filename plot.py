@@ -22,12 +22,19 @@ def scenarios(in_scenarios, selection, region, class_name, class_num):
     x_label, y_label = 'Concentration (μg/L)', 'Percentile'
 
     initialize(in_scenarios.conc, x_label, y_label, y_max=101)
+
+    # Split the scenarios and selections by koc and duration in one pass each, rather than masking for each plot
+    scenario_sets = dict(list(in_scenarios[['koc', 'duration', 'conc', '%ile']].groupby(
+        ['koc', 'duration'], observed=True, sort=False)))
+    selection_sets = dict(list(selection[['koc', 'duration', 'conc', '%ile']].groupby(
+        ['koc', 'duration'], observed=True, sort=False)))
+    empty = in_scenarios[['conc', '%ile']].iloc[:0]
     for koc in kocs:
         for duration in pwc_durations:
-            sample_set = in_scenarios[(in_scenarios.duration == duration) & (in_scenarios.koc == koc)]
+            sample_set = scenario_sets.get((koc, duration), empty)
             concs, pctiles = sample_set[['conc', '%ile']].values.T
             plt.scatter(concs, pctiles, s=1, label=duration)
-            sample_selection = selection[(selection.duration == duration) & (selection.koc == koc)]
+            sample_selection = selection_sets.get((koc, duration), empty)
             selected_conc, selected_pct = sample_selection[['conc', '%ile']].values.T
             plt.scatter(selected_conc, selected_pct, s=50)
         write.plot(region, class_name, class_num, koc, 'combined', clear=True, legend=True, legend_title='Duration')
@@ -12,7 +12,7 @@ import pandas as pd
 from parameters import kocs
 
 # Import local modules and variables
-from parameters import pwc_durations
+from parameters import pwc_durations, combo_dtypes, key_dtypes
 from paths import condensed_soil_path, met_attributes_path, combo_path, crop_dates_path, \
     crop_params_path, gen_params_path, irrigation_path, \
     pwc_scenario_path, crop_group_path, pwc_outfile_path
@@ -46,10 +46,15 @@ def combinations(region, years, nrows=None):
     for year in years:
         header = ['gridcode', 'cdl', 'weather_grid', 'mukey', 'area']
         combo_file = combo_path.format(region, year)
-        combos = pd.read_csv(combo_file, dtype=np.uint32, nrows=nrows)[header]
+        # Only the required columns are read from the parquet file
+        combos = pd.read_parquet(combo_file, columns=header).astype({f: combo_dtypes[f] for f in header})
+        if nrows is not None:
+            combos = combos.iloc[:nrows].copy()
         combos['year'] = np.int16(year)
         all_combos = combos if all_combos is None else pd.concat([all_combos, combos], axis=0)
+    # Region is used as a join key for curve numbers. As a category it's stored and joined as integer codes
     all_combos['region'] = str(region).zfill(2)
+    all_combos['region'] = all_combos.region.astype('category')
     return all_combos
 
 
@@ -71,7 +76,7 @@ def crop():
     crop_params = pd.read_csv(crop_params_path, usecols=param_fields, dtype=dtypes)
     data = crop_index.merge(crop_params, on=['cdl', 'cdl_alias'], how='left')
 
-    return data
+    return data.astype({'cdl': key_dtypes['cdl'], 'cdl_alias': key_dtypes['cdl_alias']})
 
 
 def curve_numbers(region):
@@ -84,11 +89,9 @@ def crop_dates(mode='pwc'):
     # Read crop dates
     dates = pd.read_csv(crop_dates_path)
     if mode == 'pwc':
-        dates = dates[dates.sam_only != 1]
+        dates = dates[dates.sam_only != 1].copy()
 
     # Convert dates to days since Jan 1
-    print(crop_dates_path)
-    print(dates.columns)
     dates = date_to_num(dates)
     # If date is earlier than preceeding event, move it forward a year
     # TODO - check this assumption. what if the dates are just off? should this be in modify.py?
@@ -98,13 +101,14 @@ def crop_dates(mode='pwc'):
             stage_1 = date_fields[i - 1]
             dates.loc[(dates[stage_2] < dates[stage_1]), stage_2] += 365.
 
-    return dates[fields.fetch('crop_dates')].rename(columns={'stationID': 'weather_grid'})
+    dates = dates[fields.fetch('crop_dates')].rename(columns={'stationID': 'weather_grid'})
+    return dates.astype({'cdl': key_dtypes['cdl'], 'cdl_alias': key_dtypes['cdl_alias']})
 
 
 def irrigation():
     irrigation_fields, dtypes = fields.fetch('irrigation', dtypes=True)
     irrigation_data = pd.read_csv(irrigation_path, usecols=irrigation_fields, dtype=dtypes)
-    return irrigation_data
+    return irrigation_data.astype({'cdl_alias': key_dtypes['cdl_alias']})
 
 
 def met():
@@ -160,7 +164,8 @@ def pwc_infile(class_num, class_name, path=None, fixed_base=None):
                 base = os.path.basename(p).replace("_koc10", ".csv")
             else:
                 base = fixed_base
-            new_table = pd.read_csv(os.path.join(p, base), dtype={'area': np.int64})
+            # The pyarrow reader parses with multiple threads
+            new_table = pd.read_csv(os.path.join(p, base), dtype={'area': np.int64}, engine='pyarrow')
             tables.append(new_table)
             report(f"Read file {p}")
         except FileNotFoundError as e:
@@ -210,4 +215,7 @@ def pwc_outfile(class_num=None, class_name=None, path=None):
     table = table.melt(id_vars=[f for f in table.columns if f not in pwc_durations], value_vars=pwc_durations,
                        var_name='duration', value_name='conc')
 
+    # Duration repeats for every scenario. As a category it's stored as integer codes in the order of pwc_durations
+    table['duration'] = pd.Categorical(table.duration, categories=pwc_durations)
+
     return table
@@ -9,27 +9,29 @@ import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # Import local variables
 from parameters import fields, pwc_selection_field
-from paths import sam_scenario_path, pwc_scenario_path, recipe_path, hydro_file_path, combo_path, \
+from paths import sam_scenario_path, sam_parquet_path, pwc_scenario_path, recipe_path, hydro_file_path, combo_path, \
     qc_path, summary_outfile, plot_outfile, combined_outfile, combined_results
 
 
 # TODO - create a wrapper function to makedirs automatically
 
 def combinations(region, year, table):
-    """ Write a combinations table to a csv file """
+    """ Write a combinations table to a parquet file """
     out_path = combo_path.format(region, year)
     # Create output directory
     create_dir(out_path)
-    table.to_csv(out_path, index=None)
+    table.to_parquet(out_path, index=False)
 
 
 def create_dir(out_path):
-    """ Create a directory for a file name if it doesn't exist """
-    if not os.path.exists(os.path.dirname(out_path)):
-        os.makedirs(os.path.dirname(out_path))
+    """ Create a directory for a file name if it doesn't exist.
+    Regions may be processed in separate processes, so another process may create it first """
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
 
 def scenario_summary_table(data, region, class_name, class_num):
@@ -89,6 +91,42 @@ def recipes(region, recipe_table, recipe_map, mode='mmap'):
         f.write(f"{recipe_table.shape}")
 
 
+def parquet_schema(table):
+    """ Create a parquet schema for a table from the data types in fields_and_qc.csv.
+    Fields with an 'object' data type are written as text unless they hold numbers """
+    data_types = fields.data_type(cols=table.columns)
+    schema = []
+    for field in table.columns:
+        data_type = np.dtype(data_types[field])
+        if data_type.kind == 'O' and pd.api.types.is_numeric_dtype(table[field].dtype):
+            data_type = table[field].dtype
+        arrow_type = pa.string() if data_type.kind in 'OSU' else pa.from_numpy_dtype(data_type)
+        schema.append(pa.field(field, arrow_type))
+    return pa.schema(schema)
+
+
+def sam_scenarios(region, scenario_chunks):
+    """ Write chunks of SAM scenarios to a single parquet file for a region.
+    Each chunk is written as it arrives and becomes a row group in the file.
+    If a chunk fails, the incomplete file is removed """
+    out_path = sam_parquet_path.format(region)
+    create_dir(out_path)
+    writer = None
+    completed = False
+    try:
+        for chunk in scenario_chunks:
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, parquet_schema(chunk), use_dictionary=True)
+            table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+            writer.write_table(table, row_group_size=table.num_rows)
+        completed = True
+    finally:
+        if writer is not None:
+            writer.close()
+            if not completed:
+                os.remove(out_path)
+
+
 def scenarios(scenario_matrix, mode, region, name=None, num='all'):
     """ Write a scenarios table to file
     The 'name' parameter is used to specify crop group for PWC scenarios """
@@ -110,7 +148,7 @@ def selected_scenarios(selection, first_run=False):
     selection['filename'] = selection.pwc_class.astype(np.int32).astype(str) + \
                             '_' + selection.koc.astype(str) + \
                             '_' + selection.region.astype(str) + \
-                            '_' + selection.duration
+                            '_' + selection.duration.astype(str)
 
     # Choose output fields
     scenario_fields = list(fields.fetch('pwc_scenario')) + ['filename']